@@ -2,15 +2,20 @@
 # Best of both worlds: LlamaIndex embeddings + Qdrant API
 
 import os
-import base64
 import gc
+import hashlib
 import random
-import tempfile
 import time
 import uuid
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
-from typing import List, Dict, Any
+import orjson
+from typing import List, Dict, Any, Optional, Set
+
+import numpy as np
+import pypdfium2 as pdfium
 
 
 
@@ -18,8 +23,9 @@ from llama_index.core import Settings
 from llama_index.llms.groq import Groq
 from llama_index.core import PromptTemplate
 from llama_index.embeddings.huggingface import HuggingFaceEmbedding
-from llama_index.core import VectorStoreIndex, ServiceContext, SimpleDirectoryReader
+from llama_index.core import VectorStoreIndex, ServiceContext
 from llama_index.core import Document
+from llama_index.core.node_parser import SentenceSplitter
 
 import streamlit as st
 
@@ -28,16 +34,62 @@ QDRANT_HOST = os.environ.get("QDRANT_HOST", "localhost")
 QDRANT_PORT = int(os.environ.get("QDRANT_PORT", 6333))
 QDRANT_API_URL = f"http://{QDRANT_HOST}:{QDRANT_PORT}"
 COLLECTION_NAME = "pdf_documents"
+# Fail fast when Qdrant is unreachable, but give waited writes time to finish
+QDRANT_TIMEOUT = (3.05, 60)
+# Dimension of the BGE-large embeddings
+VECTOR_SIZE = 1024
+
+# Embedding inference settings: device defaults to CUDA/MPS when available,
+# backend can be switched to "onnx" or "openvino" for faster CPU inference
+EMBED_DEVICE = os.environ.get("EMBED_DEVICE") or None
+EMBED_BACKEND = os.environ.get("EMBED_BACKEND", "torch")
+# Chunk size and overlap in tokens; kept below BGE's 512-token input limit
+CHUNK_SIZE = 384
+CHUNK_OVERLAP = 48
+# Number of chunks sent through the embedding model per forward pass
+EMBED_BATCH_SIZE = 64
+# Number of points sent to Qdrant per upsert request
+UPSERT_BATCH_SIZE = 128
+# HNSW parameters applied once the bulk upload has finished
+HNSW_CONFIG = {"m": 16, "ef_construct": 200}
+# int8 scalar quantization kept in RAM; searches oversample and rescore
+# candidates with the original vectors to preserve recall
+QUANTIZATION_CONFIG = {"scalar": {"type": "int8", "quantile": 0.99, "always_ram": True}}
+SEARCH_PARAMS = {"hnsw_ef": 64, "quantization": {"rescore": True, "oversampling": 2.0}}
+
+# Prompt used to answer queries from the retrieved context
+QA_PROMPT_TMPL_STR = (
+    "Context information is below.\n"
+    "---------------------\n"
+    "{context_str}\n"
+    "---------------------\n"
+    "Given the context information above I want you to think step by step to answer the query in a crisp manner, incase case you don't know the answer say 'I don't know!'.\n"
+    "Query: {query_str}\n"
+    "Answer: "
+)
+
+# Semantic cache: answers are reused for queries at least this similar
+SEMANTIC_CACHE_THRESHOLD = 0.95
+SEMANTIC_CACHE_TTL = 7 * 24 * 60 * 60
+SEMANTIC_CACHE_MAX_ENTRIES = 1024
+
+# Maximum number of documents listed in the sidebar
+MAX_LISTED_DOCUMENTS = 1000
+# Maximum number of history messages re-rendered on each rerun
+MAX_RENDERED_MESSAGES = 20
 
 if "id" not in st.session_state:
     st.session_state.id = uuid.uuid4()
     st.session_state.file_cache = {}
 
+if "semantic_cache" not in st.session_state:
+    st.session_state.semantic_cache = []
+
 session_id = st.session_state.id
 
 @st.cache_resource
-def load_llm():
-    api_key = st.session_state.get("groq_api_key")
+def load_llm(api_key: str):
+    # Cached per API key so changing the key in the sidebar takes effect
     if not api_key:
         st.warning("Please add your Groq API key in the sidebar to continue.")
         st.stop()
@@ -51,252 +103,564 @@ def load_llm():
 @st.cache_resource
 def load_embedding_model():
     """Load the embedding model using LlamaIndex"""
+    # Only pass the inference backend when overridden so older
+    # llama-index-embeddings-huggingface releases keep working
+    backend_kwargs = {"backend": EMBED_BACKEND} if EMBED_BACKEND != "torch" else {}
     embed_model = HuggingFaceEmbedding(
         model_name="BAAI/bge-large-en-v1.5", 
-        trust_remote_code=True
+        trust_remote_code=True,
+        normalize=True,  # unit vectors: dot product equals cosine similarity
+        embed_batch_size=EMBED_BATCH_SIZE,
+        device=EMBED_DEVICE,
+        **backend_kwargs
     )
+    # Warm up once at load so the first real query does not pay for lazy
+    # kernel/graph initialisation
+    embed_model.get_text_embedding_batch(["warmup"] * 8, show_progress=False)
     return embed_model
 
+@st.cache_data(max_entries=256, show_spinner=False)
+def embed_query(query: str) -> List[float]:
+    """Embed a query, reusing the result for exact repeats across reruns"""
+    return load_embedding_model().get_text_embedding(query)
+
+@st.cache_resource
+def get_http_session():
+    """Create a pooled keep-alive HTTP session shared by all Qdrant API calls"""
+    session = requests.Session()
+    # Bodies are serialized with orjson and sent as raw data
+    session.headers["Content-Type"] = "application/json"
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=16,
+        max_retries=Retry(total=2, backoff_factor=0.1)
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+@st.cache_resource
+def get_known_collections() -> Set[str]:
+    """Collections already confirmed to exist, shared across sessions"""
+    return set()
+
 def reset_chat():
     st.session_state.messages = []
     st.session_state.context = None
     gc.collect()
 
-def ensure_collection_exists(collection_name: str, vector_size: int = 1024):
-    """Ensure Qdrant collection exists via API"""
+@st.cache_resource
+def get_corpus_version() -> Dict[str, int]:
+    """Counter shared by all sessions, bumped whenever documents change"""
+    return {"version": 0}
+
+def bump_corpus_version():
+    """Invalidate answers cached by every session before a document change"""
+    get_corpus_version()["version"] += 1
+
+def lookup_semantic_cache(query_embedding: List[float]) -> Optional[str]:
+    """Return the cached answer of a semantically similar earlier query"""
+    cache = st.session_state.semantic_cache
+    
+    # Drop entries older than the TTL or built from an older set of documents
+    now = time.time()
+    version = get_corpus_version()["version"]
+    cache[:] = [
+        entry for entry in cache
+        if now - entry["created_at"] < SEMANTIC_CACHE_TTL and entry["corpus_version"] == version
+    ]
+    if not cache:
+        return None
+    
+    query = np.asarray(query_embedding, dtype=np.float32)
+    matrix = np.stack([entry["embedding"] for entry in cache])
+    # Embeddings are normalized, so the dot product is the cosine similarity
+    sims = matrix @ query
+    best = int(np.argmax(sims))
+    if sims[best] < SEMANTIC_CACHE_THRESHOLD:
+        return None
+    
+    # Move the hit to the end so eviction drops the least recently used entry
+    entry = cache.pop(best)
+    cache.append(entry)
+    return entry["response"]
+
+def store_semantic_cache(query_embedding: List[float], response: str, corpus_version: int):
+    """Remember an answer for semantically similar follow-up queries"""
+    cache = st.session_state.semantic_cache
+    cache.append({
+        "embedding": np.asarray(query_embedding, dtype=np.float32),
+        "response": response,
+        "created_at": time.time(),
+        "corpus_version": corpus_version
+    })
+    if len(cache) > SEMANTIC_CACHE_MAX_ENTRIES:
+        cache.pop(0)
+
+def ensure_collection_exists(collection_name: str = COLLECTION_NAME, vector_size: int = VECTOR_SIZE):
+    """Ensure Qdrant collection and its payload indexes exist via API"""
+    known_collections = get_known_collections()
+    if collection_name in known_collections:
+        return True
+    
     try:
-        # Check if collection exists
-        response = requests.get(f"{QDRANT_API_URL}/collections/{collection_name}")
-        if response.status_code == 200:
-            return True
+        # Check if collection exists without fetching its full info
+        response = get_http_session().get(f"{QDRANT_API_URL}/collections/{collection_name}/exists", timeout=QDRANT_TIMEOUT)
+        exists = response.status_code == 200 and orjson.loads(response.content)["result"]["exists"]
         
-        # Create collection if it doesn't exist
-        collection_config = {
-            "vectors": {
-                "size": vector_size,
-                "distance": "Cosine"
+        if not exists:
+            # Create collection if it doesn't exist; m=0 skips HNSW graph
+            # building while the initial points are uploaded
+            collection_config = {
+                "vectors": {
+                    "size": vector_size,
+                    # Embeddings are normalized, so Dot ranks like Cosine
+                    # without Qdrant re-normalizing vectors
+                    "distance": "Dot",
+                    "datatype": "float16",
+                    # Searches run on the in-RAM quantized copy; originals are
+                    # only read from disk when rescoring
+                    "on_disk": True
+                },
+                "hnsw_config": {
+                    "m": 0
+                },
+                "quantization_config": QUANTIZATION_CONFIG
             }
-        }
+            
+            response = get_http_session().put(
+                f"{QDRANT_API_URL}/collections/{collection_name}",
+                data=orjson.dumps(collection_config),
+                timeout=QDRANT_TIMEOUT
+            )
+            
+            if response.status_code != 200:
+                st.error(f"Failed to create collection: {response.text}")
+                return False
         
-        response = requests.put(
+        # Index filename and content hash so per-document filters, grouping,
+        # facets and duplicate checks stay fast. Index creation is idempotent,
+        # so this also backfills collections created before an index existed
+        for field_name in ("filename", "sha256"):
+            response = get_http_session().put(
+                f"{QDRANT_API_URL}/collections/{collection_name}/index",
+                params={"wait": "true"},
+                data=orjson.dumps({"field_name": field_name, "field_schema": "keyword"}),
+                timeout=QDRANT_TIMEOUT
+            )
+            
+            if response.status_code != 200:
+                st.error(f"Failed to create payload index: {response.text}")
+                return False
+        
+        known_collections.add(collection_name)
+        return True
+            
+    except Exception as e:
+        st.error(f"Error ensuring collection exists: {e}")
+        return False
+
+def enable_hnsw_index(collection_name: str) -> bool:
+    """Build the HNSW index of a collection in one pass via API"""
+    try:
+        response = get_http_session().patch(
             f"{QDRANT_API_URL}/collections/{collection_name}",
-            json=collection_config
+            data=orjson.dumps({"hnsw_config": HNSW_CONFIG}),
+            timeout=QDRANT_TIMEOUT
         )
         
         if response.status_code == 200:
             return True
         else:
-            st.error(f"Failed to create collection: {response.text}")
+            st.error(f"Failed to build index: {response.text}")
             return False
             
     except Exception as e:
-        st.error(f"Error ensuring collection exists: {e}")
+        st.error(f"Error building index: {e}")
         return False
 
-def process_pdf_with_llamaindex_and_qdrant_api(file) -> bool:
-    """Process PDF using LlamaIndex embeddings and store in Qdrant via API"""
+def is_document_stored(filename: str, digest: str) -> bool:
+    """Check via API whether this file is fully stored with this content hash"""
+    document_filter = {"must": [
+        {"key": "filename", "match": {"value": filename}},
+        {"key": "sha256", "match": {"value": digest}}
+    ]}
     try:
-        with tempfile.TemporaryDirectory() as temp_dir:
-            file_path = os.path.join(temp_dir, file.name)
-            
-            with open(file_path, "wb") as f:
-                f.write(file.getvalue())
-            
-            # Load documents using LlamaIndex
-            loader = SimpleDirectoryReader(
-                input_dir=temp_dir,
-                required_exts=[".pdf"],
-                recursive=True
-            )
-            docs = loader.load_data()
-            
-            # Get embedding model
-            embed_model = load_embedding_model()
-            
-            # Create unique collection name for this document
-            collection_name = f"{COLLECTION_NAME}_{file.name.replace('.pdf', '').replace(' ', '_')}"
-            
-            # Ensure collection exists
-            if not ensure_collection_exists(collection_name, vector_size=1024):
-                return False
-            
-            # Process each document chunk
-            points = []
-            for i, doc in enumerate(docs):
-                # Get text content
-                text = doc.text
-                
-                # Create embedding using LlamaIndex
-                embedding = embed_model.get_text_embedding(text)
-                
-                # Create point for Qdrant with UUID
-                point = {
-                    "id": str(uuid.uuid4()),
-                    "vector": embedding,
-                    "payload": {
-                        "text": text,
-                        "document_id": collection_name,
-                        "filename": file.name,
-                        "chunk_index": i,
-                        "total_chunks": len(docs)
-                    }
-                }
-                points.append(point)
-            
-            # Upload points to Qdrant via API
-            response = requests.put(
-                f"{QDRANT_API_URL}/collections/{collection_name}/points",
-                json={"points": points}
-            )
+        response = get_http_session().post(
+            f"{QDRANT_API_URL}/collections/{COLLECTION_NAME}/points/scroll",
+            data=orjson.dumps({
+                "filter": document_filter,
+                "limit": 1,
+                "with_payload": ["total_chunks"],
+                "with_vector": False
+            }),
+            timeout=QDRANT_TIMEOUT
+        )
+        if response.status_code != 200:
+            return False
+        points = orjson.loads(response.content)["result"]["points"]
+        if not points:
+            return False
+        
+        # A failed upload can leave only some batches behind, so the stored
+        # chunk count must match before the file counts as stored
+        response = get_http_session().post(
+            f"{QDRANT_API_URL}/collections/{COLLECTION_NAME}/points/count",
+            data=orjson.dumps({"filter": document_filter, "exact": True}),
+            timeout=QDRANT_TIMEOUT
+        )
+        if response.status_code != 200:
+            return False
+        stored_chunks = orjson.loads(response.content)["result"]["count"]
+        return stored_chunks == points[0]["payload"]["total_chunks"]
+    except Exception as e:
+        st.error(f"Error checking for stored document: {e}")
+        return False
+
+def delete_stale_chunks(filename: str, digest: str) -> bool:
+    """Delete chunks left over from an earlier version of a file via API"""
+    # Only call once the new version is confirmed complete, otherwise the
+    # previous complete copy is replaced by a partial one
+    try:
+        response = get_http_session().post(
+            f"{QDRANT_API_URL}/collections/{COLLECTION_NAME}/points/delete",
+            params={"wait": "true"},
+            data=orjson.dumps({"filter": {
+                "must": [{"key": "filename", "match": {"value": filename}}],
+                "must_not": [{"key": "sha256", "match": {"value": digest}}]
+            }}),
+            timeout=QDRANT_TIMEOUT
+        )
+        
+        if response.status_code == 200:
+            return True
+        else:
+            st.error(f"Failed to remove previous version: {response.text}")
+            return False
             
-            if response.status_code == 200:
-                #st.success(f"✅ Uploaded {len(points)} chunks to Qdrant")
-                return True
-            else:
-                st.error(f"Failed to upload to Qdrant: {response.text}")
-                return False
-                
     except Exception as e:
-        st.error(f"Error processing PDF: {e}")
+        st.error(f"Error removing previous version: {e}")
         return False
 
-def search_qdrant_api(query: str, limit: int = 10) -> List[Dict[str, Any]]:
-    """Search documents in Qdrant via API"""
+def get_stored_vectors(point_ids: List[str]) -> Dict[str, List[float]]:
+    """Fetch the vectors of already stored points via API"""
+    if not point_ids:
+        return {}
     try:
-        # Get embedding for query using LlamaIndex
+        response = get_http_session().post(
+            f"{QDRANT_API_URL}/collections/{COLLECTION_NAME}/points",
+            data=orjson.dumps({"ids": point_ids, "with_payload": False, "with_vector": True}),
+            timeout=QDRANT_TIMEOUT
+        )
+        if response.status_code != 200:
+            return {}
+        return {point["id"]: point["vector"] for point in orjson.loads(response.content)["result"]}
+    except Exception as e:
+        st.error(f"Error fetching stored vectors: {e}")
+        return {}
+
+def load_pdf_pages(data: bytes) -> List[Document]:
+    """Extract the text of each PDF page with PDFium"""
+    # PDFium is not thread-safe, so pages are extracted sequentially
+    pdf = pdfium.PdfDocument(data)
+    try:
+        texts = []
+        for page in pdf:
+            # Release each page's native buffers as soon as its text is read
+            textpage = page.get_textpage()
+            texts.append(textpage.get_text_range())
+            textpage.close()
+            page.close()
+    finally:
+        pdf.close()
+    return [Document(text=text) for text in texts if text.strip()]
+
+def process_pdf_with_llamaindex_and_qdrant_api(file) -> bool:
+    """Process PDF using LlamaIndex embeddings and store in Qdrant via API"""
+    try:
+        # Read the upload once; hashing and parsing share the same buffer
+        data = file.getvalue()
+        digest = hashlib.sha256(data).hexdigest()
+        
+        # Ensure collection exists
+        if not ensure_collection_exists(COLLECTION_NAME, vector_size=VECTOR_SIZE):
+            return False
+        
+        # Skip the whole pipeline when identical content is already fully
+        # stored; a partial earlier upload falls through and is re-ingested in
+        # place, since point ids are deterministic
+        if is_document_stored(file.name, digest):
+            # The new version is confirmed complete, so the previous one can go
+            if not delete_stale_chunks(file.name, digest):
+                return False
+            st.session_state.file_cache[file.file_id] = digest
+            return True
+        
+        # Load one document per page with PDFium
+        docs = load_pdf_pages(data)
+        
+        # Get embedding model
         embed_model = load_embedding_model()
-        query_embedding = embed_model.get_text_embedding(query)
         
-        # Get all collections
-        collections = get_all_collections()
+        # Create unique document id; all documents share one collection
+        document_id = f"{COLLECTION_NAME}_{file.name.replace('.pdf', '').replace(' ', '_')}"
         
-        if not collections:
-            st.warning("No collections found in Qdrant")
-            return []
+        # Split pages into overlapping, sentence-aligned chunks that fit the
+        # embedding model's input window
+        splitter = SentenceSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+        texts = [node.get_content() for node in splitter.get_nodes_from_documents(docs)]
+        if not texts:
+            st.error("No extractable text found in this PDF (is it a scanned image?)")
+            return False
         
-        #st.info(f"🔍 Searching across {len(collections)} collections: {', '.join(collections)}")
+        # Derive point ids from file name and chunk text, so re-uploads map
+        # unchanged chunks onto their stored points; repeated chunks collapse
+        chunks = {
+            str(uuid.uuid5(uuid.NAMESPACE_URL, f"{file.name}\n{text}")): text
+            for text in texts
+        }
+        point_ids, texts = list(chunks), list(chunks.values())
         
-        all_results = []
+        # Reuse vectors of chunks that are already stored; vectors go over
+        # the wire as float16 to match the collection's storage datatype
+        stored_vectors = get_stored_vectors(point_ids)
+        embeddings = np.empty((len(texts), VECTOR_SIZE), dtype=np.float16)
+        missing = []
+        for i, point_id in enumerate(point_ids):
+            if point_id in stored_vectors:
+                embeddings[i] = stored_vectors[point_id]
+            else:
+                missing.append(i)
         
-        for collection in collections:
-            # Search in each collection - limit to max 3 results per document
-            search_payload = {
-                "vector": query_embedding,
-                "limit": min(3, limit),  # similarity_top_k = max 3 per document
-                "with_payload": True
-            }
-            
-            response = requests.post(
-                f"{QDRANT_API_URL}/collections/{collection}/points/search",
-                json=search_payload
+        # Embed the remaining chunks in one batched pass; sorting by length
+        # keeps similarly sized texts in the same sub-batch to cut padding
+        order = sorted(missing, key=lambda i: len(texts[i]))
+        if order:
+            embeddings[order] = embed_model.get_text_embedding_batch(
+                [texts[i] for i in order], show_progress=False
             )
-            
-            if response.status_code == 200:
-                results = response.json()["result"]
-                #st.info(f"📄 Found {len(results)} results in collection: {collection}")
-                
-                for result in results:
-                    all_results.append({
-                        "score": result["score"],
-                        "document_id": result["payload"]["document_id"],
-                        "filename": result["payload"]["filename"],
-                        "chunk_index": result["payload"]["chunk_index"],
-                        "text": result["payload"]["text"],
-                        "total_chunks": result["payload"]["total_chunks"]
-                    })
-            else:
-                st.error(f"Failed to search collection {collection}: {response.text}")
         
-        # Sort by score
-        all_results.sort(key=lambda x: x["score"], reverse=True)
-        #st.info(f"🎯 Total results found: {len(all_results)}")
+        # Payload for each document chunk; points keep their content-derived UUIDs
+        payloads = [
+            {
+                "text": text,
+                "document_id": document_id,
+                "filename": file.name,
+                "sha256": digest,
+                "chunk_index": i,
+                "total_chunks": len(texts)
+            }
+            for i, text in enumerate(texts)
+        ]
         
-        # Ensure we get results from multiple documents
-        if len(all_results) > limit:
-            # Group results by document
-            doc_results = {}
-            for result in all_results:
-                filename = result['filename']
-                if filename not in doc_results:
-                    doc_results[filename] = []
-                doc_results[filename].append(result)
-            
-            # Calculate how many results to take from each document
-            num_docs = len(doc_results)
-            if num_docs <= 5:
-                # For small number of docs, take more from each
-                results_per_doc = max(1, limit // num_docs)
-            else:
-                # For many docs, ensure we get at least 1 from each, but prioritize top-scoring
-                results_per_doc = 1
-                remaining_slots = limit - num_docs
-                # Distribute remaining slots to top-scoring documents
-                sorted_docs = sorted(doc_results.items(), 
-                                   key=lambda x: max(r['score'] for r in x[1]), 
-                                   reverse=True)
-                
-                balanced_results = []
-                for i, (filename, results) in enumerate(sorted_docs):
-                    if i < remaining_slots:
-                        # Take 2 results from top documents
-                        balanced_results.extend(results[:2])
-                    else:
-                        # Take 1 result from remaining documents
-                        balanced_results.extend(results[:1])
-                
-                # Sort by score and return
-                balanced_results.sort(key=lambda x: x["score"], reverse=True)
-                #st.info(f"⚖️ Balanced results from {num_docs} documents: {len(balanced_results)} total")
-                return balanced_results[:limit]
-            
-            # Original logic for small number of documents
-            balanced_results = []
-            for filename, results in doc_results.items():
-                balanced_results.extend(results[:results_per_doc])
+        # Upload points to Qdrant via API in bounded batches using the columnar
+        # batch format, so each vector block is serialized straight from the
+        # NumPy buffer; only the last batch waits, since Qdrant applies
+        # updates in order
+        session = get_http_session()
+        for start in range(0, len(point_ids), UPSERT_BATCH_SIZE):
+            end = start + UPSERT_BATCH_SIZE
+            batch = {
+                "ids": point_ids[start:end],
+                "vectors": embeddings[start:end],
+                "payloads": payloads[start:end]
+            }
+            response = session.put(
+                f"{QDRANT_API_URL}/collections/{COLLECTION_NAME}/points",
+                params={"wait": "true" if end >= len(point_ids) else "false"},
+                data=orjson.dumps({"batch": batch}, option=orjson.OPT_SERIALIZE_NUMPY),
+                timeout=QDRANT_TIMEOUT
+            )
             
-            # Sort by score again and return
-            balanced_results.sort(key=lambda x: x["score"], reverse=True)
-            #st.info(f"⚖️ Balanced results from {num_docs} documents: {len(balanced_results)} total")
-            return balanced_results[:limit]
+            if response.status_code != 200:
+                # The collection may have been removed behind our back
+                get_known_collections().discard(COLLECTION_NAME)
+                st.error(f"Failed to upload to Qdrant: {response.text}")
+                return False
         
-        return all_results[:limit]
+        #st.success(f"✅ Uploaded {len(point_ids)} chunks to Qdrant")
+        # Every batch succeeded and the last one waited for all of them to be
+        # applied, so the previous version can go
+        if not delete_stale_chunks(file.name, digest):
+            return False
+        
+        if not enable_hnsw_index(COLLECTION_NAME):
+            return False
         
+        st.session_state.file_cache[file.file_id] = digest
+        return True
+            
     except Exception as e:
-        st.error(f"Error searching Qdrant: {e}")
+        st.error(f"Error processing PDF: {e}")
+        return False
+
+@st.cache_data(ttl=300, max_entries=256, show_spinner=False)
+def search_qdrant_api(
+    query: str, limit: int = 10, _query_embedding: Optional[List[float]] = None
+) -> List[Dict[str, Any]]:
+    """Search documents in Qdrant via API; raises on failure so errors are not cached"""
+    # Get embedding for query using LlamaIndex unless already computed;
+    # the underscore keeps it out of the cache key
+    query_embedding = _query_embedding
+    if query_embedding is None:
+        query_embedding = embed_query(query)
+    
+    # Search once, grouped by document - max 3 results per document
+    search_payload = {
+        "query": query_embedding,
+        "group_by": "filename",
+        "limit": limit,
+        "group_size": 3,  # similarity_top_k = max 3 per document
+        # Only fetch the payload fields used to build the context
+        "with_payload": ["text", "document_id", "filename", "chunk_index", "total_chunks"],
+        "params": SEARCH_PARAMS
+    }
+    
+    response = get_http_session().post(
+        f"{QDRANT_API_URL}/collections/{COLLECTION_NAME}/points/query/groups",
+        data=orjson.dumps(search_payload),
+        timeout=QDRANT_TIMEOUT
+    )
+    
+    if response.status_code == 404:
+        raise RuntimeError("No documents found in Qdrant")
+    if response.status_code != 200:
+        raise RuntimeError(f"Failed to search documents: {response.text}")
+    
+    # Flatten groups, remembering each hit's rank within its document
+    hits = [
+        (rank, result)
+        for group in orjson.loads(response.content)["result"]["groups"]
+        for rank, result in enumerate(group["hits"])
+    ]
+    if not hits:
         return []
+    scores = np.fromiter((result["score"] for _, result in hits), dtype=np.float32, count=len(hits))
+    ranks = np.fromiter((rank for rank, _ in hits), dtype=np.int32, count=len(hits))
+    
+    # Ensure we get results from multiple documents: every document's best
+    # hit is taken before any document's second, then sort by score
+    selected = np.lexsort((-scores, ranks))[:limit]
+    selected = selected[np.argsort(-scores[selected], kind="stable")]
+    
+    balanced_results = []
+    for i in selected:
+        result = hits[i][1]
+        balanced_results.append({
+            "score": result["score"],
+            "document_id": result["payload"]["document_id"],
+            "filename": result["payload"]["filename"],
+            "chunk_index": result["payload"]["chunk_index"],
+            "text": result["payload"]["text"],
+            "total_chunks": result["payload"]["total_chunks"]
+        })
+    return balanced_results
 
-def get_all_collections() -> List[str]:
-    """Get all document collections from Qdrant via API"""
-    try:
-        response = requests.get(f"{QDRANT_API_URL}/collections")
-        if response.status_code == 200:
-            collections = response.json()["result"]["collections"]
-            # Filter collections that start with our prefix
-            doc_collections = [
-                col["name"] for col in collections 
-                if col["name"].startswith(COLLECTION_NAME)
-            ]
-            return doc_collections
-        else:
-            st.error(f"Failed to get collections: {response.text}")
-            return []
-    except Exception as e:
-        st.error(f"Error getting collections: {e}")
+@st.cache_data(ttl=30, show_spinner=False)
+def get_all_documents() -> List[str]:
+    """Get the filenames of all stored documents from Qdrant via API; raises on failure so errors are not cached"""
+    response = get_http_session().post(
+        f"{QDRANT_API_URL}/collections/{COLLECTION_NAME}/facet",
+        # Only the distinct filenames are used, so approximate counts suffice
+        data=orjson.dumps({"key": "filename", "limit": MAX_LISTED_DOCUMENTS, "exact": False}),
+        timeout=QDRANT_TIMEOUT
+    )
+    if response.status_code == 200:
+        hits = orjson.loads(response.content)["result"]["hits"]
+        return sorted(hit["value"] for hit in hits)
+    elif response.status_code == 404:
+        # Collection is created with the first upload
         return []
+    else:
+        raise RuntimeError(f"Failed to get documents: {response.text}")
 
-def delete_collection_api(collection_name: str) -> bool:
-    """Delete a collection from Qdrant via API"""
+def delete_document_api(filename: str) -> bool:
+    """Delete all chunks of a document from Qdrant via API"""
     try:
-        response = requests.delete(f"{QDRANT_API_URL}/collections/{collection_name}")
+        response = get_http_session().post(
+            f"{QDRANT_API_URL}/collections/{COLLECTION_NAME}/points/delete",
+            params={"wait": "true"},
+            data=orjson.dumps({"filter": {"must": [{"key": "filename", "match": {"value": filename}}]}}),
+            timeout=QDRANT_TIMEOUT
+        )
         return response.status_code == 200
     except Exception as e:
-        st.error(f"Error deleting collection: {e}")
+        st.error(f"Error deleting document: {e}")
         return False
 
+@st.cache_resource(show_spinner="Migrating documents from older collections...")
+def migrate_legacy_collections() -> int:
+    """Move per-document collections of earlier versions into the shared collection via API; raises on failure so it is retried"""
+    session = get_http_session()
+    response = session.get(f"{QDRANT_API_URL}/collections", timeout=QDRANT_TIMEOUT)
+    if response.status_code != 200:
+        raise RuntimeError(f"Failed to get collections: {response.text}")
+    legacy_collections = [
+        col["name"] for col in orjson.loads(response.content)["result"]["collections"]
+        if col["name"].startswith(f"{COLLECTION_NAME}_")
+    ]
+    if not legacy_collections:
+        return 0
+    
+    if not ensure_collection_exists(COLLECTION_NAME, vector_size=VECTOR_SIZE):
+        raise RuntimeError(f"Failed to prepare collection {COLLECTION_NAME}")
+    
+    for collection in legacy_collections:
+        # Copy page by page, re-keying points the way new uploads are keyed
+        offset = None
+        while True:
+            scroll = {"limit": UPSERT_BATCH_SIZE, "with_payload": True, "with_vector": True}
+            if offset is not None:
+                scroll["offset"] = offset
+            response = session.post(
+                f"{QDRANT_API_URL}/collections/{collection}/points/scroll",
+                data=orjson.dumps(scroll),
+                timeout=QDRANT_TIMEOUT
+            )
+            if response.status_code != 200:
+                raise RuntimeError(f"Failed to read collection {collection}: {response.text}")
+            result = orjson.loads(response.content)["result"]
+            
+            if result["points"]:
+                batch = {
+                    "ids": [
+                        str(uuid.uuid5(uuid.NAMESPACE_URL, f"{point['payload']['filename']}\n{point['payload']['text']}"))
+                        for point in result["points"]
+                    ],
+                    "vectors": [point["vector"] for point in result["points"]],
+                    "payloads": [point["payload"] for point in result["points"]]
+                }
+                response = session.put(
+                    f"{QDRANT_API_URL}/collections/{COLLECTION_NAME}/points",
+                    params={"wait": "true"},
+                    data=orjson.dumps({"batch": batch}),
+                    timeout=QDRANT_TIMEOUT
+                )
+                if response.status_code != 200:
+                    raise RuntimeError(f"Failed to copy collection {collection}: {response.text}")
+            
+            offset = result.get("next_page_offset")
+            if offset is None:
+                break
+        
+        # Only drop the old collection once all of its points were copied
+        response = session.delete(f"{QDRANT_API_URL}/collections/{collection}", timeout=QDRANT_TIMEOUT)
+        if response.status_code != 200:
+            raise RuntimeError(f"Failed to delete collection {collection}: {response.text}")
+    
+    if not enable_hnsw_index(COLLECTION_NAME):
+        raise RuntimeError(f"Failed to build index of {COLLECTION_NAME}")
+    
+    bump_corpus_version()
+    get_all_documents.clear()
+    search_qdrant_api.clear()
+    return len(legacy_collections)
+
+@st.cache_data(ttl=10, show_spinner=False)
 def check_qdrant_health():
     """Check if Qdrant is running via API"""
     try:
-        response = requests.get(f"{QDRANT_API_URL}/collections", timeout=5)
+        response = get_http_session().get(f"{QDRANT_API_URL}/healthz", timeout=0.5)
         return response.status_code == 200
     except:
         return False
@@ -311,16 +675,26 @@ with st.sidebar:
     if not check_qdrant_health():
         st.error("⚠️ Qdrant is not running. Please start the Docker container first:")
         st.code("docker run -d -p 6333:6333 qdrant/qdrant:latest")
-    # else:
-    #     st.success("✅ Qdrant is running!")
+        st.button("🔄 Recheck", on_click=check_qdrant_health.clear)
+    else:
+        #st.success("✅ Qdrant is running!")
+        # One-time move of documents stored by earlier per-document collections
+        try:
+            migrate_legacy_collections()
+        except Exception as e:
+            st.error(f"Failed to migrate documents from older collections: {e}")
     
     # File uploader and upload logic (should come right after Qdrant health status)
     uploaded_file = st.file_uploader("Choose your `.pdf` file", type="pdf")
-    if uploaded_file:
+    # Streamlit keeps the upload across reruns; only process it once
+    if uploaded_file and uploaded_file.file_id not in st.session_state.file_cache:
         try:
             st.write("Processing your document...")
             success = process_pdf_with_llamaindex_and_qdrant_api(uploaded_file)
             if success:
+                bump_corpus_version()
+                get_all_documents.clear()
+                search_qdrant_api.clear()
                 st.success(f"✅ Document processed and stored in Qdrant!")
             else:
                 st.error("Failed to process document")
@@ -329,18 +703,23 @@ with st.sidebar:
             st.stop()
     
     # Always show stored documents section
-    collections = get_all_collections()
-    if collections:
+    try:
+        documents = get_all_documents()
+    except Exception as e:
+        st.error(f"Error getting documents: {e}")
+        documents = []
+    if documents:
         st.subheader("📚 Stored Documents")
-        for collection in collections:
+        for filename in documents:
             col1, col2 = st.columns([3, 1])
             with col1:
-                # Extract filename from collection name
-                filename = collection.replace(f"{COLLECTION_NAME}_", "").replace("_", " ") + ".pdf"
                 st.write(f"📄 {filename}")
             with col2:
-                if st.button("🗑️", key=f"delete_{collection}"):
-                    if delete_collection_api(collection):
+                if st.button("🗑️", key=f"delete_{filename}"):
+                    if delete_document_api(filename):
+                        bump_corpus_version()
+                        get_all_documents.clear()
+                        search_qdrant_api.clear()
                         st.success("Document deleted!")
                         st.rerun()
 
@@ -361,8 +740,8 @@ if not st.session_state.get("groq_api_key"):
 if "messages" not in st.session_state:
     reset_chat()
 
-# Display chat messages from history on app rerun
-for message in st.session_state.messages:
+# Display the most recent chat messages from history on app rerun
+for message in st.session_state.messages[-MAX_RENDERED_MESSAGES:]:
     with st.chat_message(message["role"]):
         st.markdown(message["content"])
 
@@ -381,69 +760,72 @@ if prompt := st.chat_input("What's up?"):
         full_response = ""
         
         try:
-            # Get number of documents to calculate appropriate limit
-            collections = get_all_collections()
-            num_docs = len(collections)
+            # Embed the prompt once and try the semantic cache first
+            query_embedding = embed_query(prompt)
+            # Taken before searching, so an answer racing a document change
+            # is cached under the older version and discarded
+            corpus_version = get_corpus_version()["version"]
+            cached_response = lookup_semantic_cache(query_embedding)
             
-            # Smart dynamic limit: scales with number of documents but stays reasonable
-            # For 100 docs: limit = min(100, 5 * 20) = 100, but capped at 30
-            # For 10 docs: limit = min(10, 5 * 2) = 10
-            # For 5 docs: limit = min(5, 5 * 1) = 5
-            dynamic_limit = min(num_docs * 5, 30)  # Cap at 30 to avoid too many results
+            if cached_response is not None:
+                full_response = cached_response
+            else:
+                # Get number of documents to calculate appropriate limit
+                documents = get_all_documents()
+                num_docs = len(documents)
             
-            #st.info(f"📊 Searching with limit {dynamic_limit} for {num_docs} documents")
+                # Smart dynamic limit: scales with number of documents but stays reasonable
+                # For 100 docs: limit = min(100, 5 * 20) = 100, but capped at 30
+                # For 10 docs: limit = min(10, 5 * 2) = 10
+                # For 5 docs: limit = min(5, 5 * 1) = 5
+                dynamic_limit = min(num_docs * 5, 30)  # Cap at 30 to avoid too many results
             
-            # Search Qdrant via API
-            search_results = search_qdrant_api(prompt, limit=dynamic_limit)
+                #st.info(f"📊 Searching with limit {dynamic_limit} for {num_docs} documents")
             
-            if not search_results:
-                full_response = "No documents have been uploaded yet or no relevant information found."
-            else:
-                # Debug: Show what documents were found
-                #st.info(f"🔍 Found {len(search_results)} relevant chunks from search")
-                
-                # Group results by document
-                docs_found = set()
-                for result in search_results:
-                    docs_found.add(result['filename'])
-                #st.info(f"📚 Documents found: {', '.join(docs_found)}")
+                # Search Qdrant via API
+                search_results = search_qdrant_api(
+                    prompt, limit=dynamic_limit, _query_embedding=query_embedding
+                ) if num_docs else []
+            
+                if not search_results:
+                    full_response = "No documents have been uploaded yet or no relevant information found."
+                else:
+                    # Debug: Show what documents were found
+                    #st.info(f"🔍 Found {len(search_results)} relevant chunks from search")
                 
-                # Load LLM
-                llm = load_llm()
+                    # Group results by document
+                    docs_found = set()
+                    for result in search_results:
+                        docs_found.add(result['filename'])
+                    #st.info(f"📚 Documents found: {', '.join(docs_found)}")
                 
-                # Create context from search results
-                context_parts = []
-                for result in search_results:
-                    context_parts.append(f"Document: {result['filename']}\nChunk {result['chunk_index'] + 1}:\n{result['text']}\n")
+                    # Load LLM
+                    llm = load_llm(st.session_state.get("groq_api_key"))
                 
-                context = "\n".join(context_parts)
+                    # Create context from search results
+                    context_parts = []
+                    for result in search_results:
+                        context_parts.append(f"Document: {result['filename']}\nChunk {result['chunk_index'] + 1}:\n{result['text']}\n")
                 
-                # Create prompt with context
-                qa_prompt_tmpl_str = (
-                    "Context information is below.\n"
-                    "---------------------\n"
-                    "{context_str}\n"
-                    "---------------------\n"
-                    "Given the context information above I want you to think step by step to answer the query in a crisp manner, incase case you don't know the answer say 'I don't know!'.\n"
-                    "Query: {query_str}\n"
-                    "Answer: "
-                )
+                    context = "\n".join(context_parts)
                 
-                # Format the prompt
-                formatted_prompt = qa_prompt_tmpl_str.format(
-                    context_str=context,
-                    query_str=prompt
-                )
+                    # Format the prompt with context
+                    formatted_prompt = QA_PROMPT_TMPL_STR.format(
+                        context_str=context,
+                        query_str=prompt
+                    )
                 
-                # Get response from LLM
-                response = llm.complete(formatted_prompt)
-                full_response = response.text
+                    # Stream response from LLM, rendering tokens as they arrive
+                    for response in llm.stream_complete(formatted_prompt):
+                        full_response += response.delta or ""
+                        message_placeholder.markdown(full_response + "▌")
+                    store_semantic_cache(query_embedding, full_response, corpus_version)
                 
-                # Show sources if available
-                # if search_results:
-                #     full_response += "\n\n**Sources:**\n"
-                #     for i, result in enumerate(search_results[:3], 1):
-                #         full_response += f"{i}. {result['filename']} (Chunk {result['chunk_index'] + 1})\n"
+                    # Show sources if available
+                    # if search_results:
+                    #     full_response += "\n\n**Sources:**\n"
+                    #     for i, result in enumerate(search_results[:3], 1):
+                    #         full_response += f"{i}. {result['filename']} (Chunk {result['chunk_index'] + 1})\n"
             
         except Exception as e:
             full_response = f"Sorry, I encountered an error: {str(e)}"
@@ -456,11 +838,11 @@ if prompt := st.chat_input("What's up?"):
 # Add database info
 # if st.sidebar.checkbox("Show database info"):
 #     st.sidebar.subheader("📊 Qdrant Database Info")
-#     collections = get_all_collections()
-#     st.sidebar.write(f"Total documents: {len(collections)}")
+#     documents = get_all_documents()
+#     st.sidebar.write(f"Total documents: {len(documents)}")
     
-#     if collections:
-#         for collection in collections:
-#             st.sidebar.write(f"• {collection}")
+#     if documents:
+#         for filename in documents:
+#             st.sidebar.write(f"• {filename}")
 #     else:
 #         st.sidebar.write("No documents in database") 
\ No newline at end of file